@@ -2,27 +2,121 @@ import numpy as np
 import librosa
 import pretty_midi
 import os
+import hashlib
+import functools
+from concurrent.futures import ThreadPoolExecutor
 import soundfile as sf
+import scipy.fft
+from scipy.signal import get_window
+from numba import njit
+from synth import render_midi
 
-def audio_to_midi(input_file, output_midi, 
-                 instrument=0, min_note_duration=0.15, 
-                 min_note_gap=0.1, threshold=0.1, 
-                 sample_rate=22050,
-                 output_wav=None,
-                 soundfont_path="FluidR3_GM.sf2"):
+def load_audio(input_file, sample_rate=22050, cache_dir="cache"):
     """
-    Convert audio to MIDI with realistic piano timing constraints,
-    then synthesize MIDI to WAV using fluidsynth.
+    Load audio as mono float32 at sample_rate. Decoded audio is cached in
+    cache_dir by file contents, so loading the same recording again skips
+    decoding and resampling.
     
     Parameters:
         input_file: Input audio file path
-        output_midi: Output MIDI file path
-        output_wav: Output WAV file path
-        soundfont_path: Path to .sf2 SoundFont for MIDI synthesis
+        sample_rate: Sample rate to resample to
+        cache_dir: Directory for decoded audio (None disables the cache)
     """
-    # Load audio file
-    y, sr = librosa.load(input_file, sr=sample_rate)
+    if cache_dir is not None:
+        # Hash in 1 MiB chunks so long recordings never sit in memory twice
+        hasher = hashlib.sha256()
+        with open(input_file, "rb") as f:
+            while chunk := f.read(1 << 20):
+                hasher.update(chunk)
+        digest = hasher.hexdigest()
+        cache_path = os.path.join(cache_dir, f"{digest}_{sample_rate}.f32.npy")
+        if os.path.exists(cache_path):
+            return np.load(cache_path, mmap_mode='r'), sample_rate
+
+    # Decode with soundfile and only resample when the file isn't already at sample_rate
+    y, sr = sf.read(input_file, dtype='float32')
+    if y.ndim > 1:
+        y = y.mean(axis=1, dtype=np.float32)
+    if sr != sample_rate:
+        y = librosa.resample(y, orig_sr=sr, target_sr=sample_rate)
+        sr = sample_rate
+
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp.npy"
+        np.save(tmp_path, y)
+        os.replace(tmp_path, cache_path)
+    return y, sr
+
+@functools.lru_cache(maxsize=None)
+def hann_window(n_fft):
+    """Periodic Hann window (the one librosa.stft uses), built once per size"""
+    window = get_window('hann', n_fft, fftbins=True).astype(np.float32)
+    window.flags.writeable = False
+    return window
+
+@njit(cache=True)
+def build_notes(midi_numbers, velocities, peak_mags, times, threshold,
+                min_note_gap, min_note_duration, end_time):
+    """
+    Track note onsets frame by frame and return the finished notes as
+    (pitches, starts, ends, velocities) arrays. A note ends when the same
+    pitch starts again or, failing that, at end_time.
+    """
+    n_frames = len(times)
+    pitches = np.empty(n_frames + 128, dtype=np.int16)
+    starts = np.empty(n_frames + 128, dtype=np.float64)
+    ends = np.empty(n_frames + 128, dtype=np.float64)
+    note_velocities = np.empty(n_frames + 128, dtype=np.int16)
+    count = 0
+
+    # Start time and velocity of the sounding note per pitch, -1 when silent
+    active_start = np.full(128, -1.0)
+    active_vel = np.zeros(128, dtype=np.int16)
+    last_note_time = -min_note_gap
+
+    for i in range(n_frames):
+        if peak_mags[i] < threshold:
+            continue
+        current_time = times[i]
+        if current_time - last_note_time >= min_note_gap:
+            note_number = midi_numbers[i]
+            start_time = active_start[note_number]
+            if start_time >= 0 and current_time - start_time >= min_note_duration:
+                pitches[count] = note_number
+                starts[count] = start_time
+                ends[count] = current_time
+                note_velocities[count] = active_vel[note_number]
+                count += 1
+            active_start[note_number] = current_time
+            active_vel[note_number] = velocities[i]
+            last_note_time = current_time
+
+    # Close notes still sounding at the end, in the order they started
+    for note_number in np.argsort(active_start):
+        start_time = active_start[note_number]
+        if start_time < 0:
+            continue
+        duration = end_time - start_time
+        if duration >= min_note_duration:
+            pitches[count] = note_number
+            starts[count] = start_time
+            ends[count] = start_time + duration
+            note_velocities[count] = active_vel[note_number]
+            count += 1
+
+    return pitches[:count], starts[:count], ends[:count], note_velocities[:count]
+
+def build_midi(y, sr, instrument=0, min_note_duration=0.15,
+               min_note_gap=0.1, threshold=0.1):
+    """
+    Detect the most prominent note over time in a mono signal and return
+    it as a PrettyMIDI object with realistic piano timing constraints.
     
+    Parameters:
+        y: Mono audio signal
+        sr: Sample rate of y
+    """
     # Create PrettyMIDI object with realistic tempo (80-120 BPM)
     midi = pretty_midi.PrettyMIDI(initial_tempo=100)
     
@@ -32,71 +126,107 @@ def audio_to_midi(input_file, output_midi,
         instrument_program = instrument
     midi_instrument = pretty_midi.Instrument(program=instrument_program)
     
-    # STFT parameters
-    n_fft = 2048
-    hop_length = n_fft // 4
-    win_length = n_fft
+    # STFT parameters, peak interpolation below makes up for the coarser bins
+    n_fft = 1024
+    hop_length = 512
     
-    # Compute STFT
-    stft = librosa.stft(y, n_fft=n_fft, hop_length=hop_length, win_length=win_length)
-    magnitude = np.abs(stft)
+    # Compute STFT: centered Hann-windowed frames like librosa.stft, FFT'd in one multi-threaded call
+    padded = np.pad(y, n_fft // 2)
+    windows = np.lib.stride_tricks.sliding_window_view(padded, n_fft)[::hop_length]
+    # Kept as (time, freq) so every frame is a contiguous row for the reductions below
+    stft = scipy.fft.rfft(windows * hann_window(n_fft), axis=1, workers=-1)
     freqs = librosa.fft_frequencies(sr=sr, n_fft=n_fft)
+
+    # Only keep bins that round to a piano key (A0-C8), nothing else can become a note
+    band = slice(*np.searchsorted(freqs, librosa.midi_to_hz([20.5, 108.5])))
+    magnitude = np.abs(stft[:, band])
     
-    # Variables to track timing constraints
-    last_note_time = -min_note_gap
-    active_notes = {}
-
-    # Process each time frame
-    for i in range(magnitude.shape[1]):
-        current_time = i * hop_length / sr
-        frame = magnitude[:, i]
-        max_mag = np.max(frame)
-        if max_mag < threshold:
-            continue
-        prominent_freq = freqs[np.argmax(frame)]
-        if prominent_freq <= 0:
-            continue
-        note_number = int(round(librosa.hz_to_midi(prominent_freq)))
-        velocity = int(min(127, max_mag * 100))
-        
-        if current_time - last_note_time >= min_note_gap:
-            if note_number in active_notes:
-                start_time, old_velocity = active_notes.pop(note_number)
-                duration = current_time - start_time
-                if duration >= min_note_duration:
-                    note = pretty_midi.Note(
-                        velocity=old_velocity,
-                        pitch=note_number,
-                        start=start_time,
-                        end=current_time
-                    )
-                    midi_instrument.notes.append(note)
-            active_notes[note_number] = (current_time, velocity)
-            last_note_time = current_time
+    # Find the most prominent bin of every frame in one pass
+    frames = np.arange(magnitude.shape[0])
+    peak_bins = magnitude.argmax(axis=1)
+    peak_mags = magnitude[frames, peak_bins]
+    frame_period = hop_length / sr
+    times = frames * frame_period
+    end_of_audio = len(frames) * frame_period
 
-    for note_number, (start_time, velocity) in active_notes.items():
-        duration = (len(magnitude[0]) * hop_length / sr) - start_time
-        if duration >= min_note_duration:
-            note = pretty_midi.Note(
-                velocity=velocity,
-                pitch=note_number,
-                start=start_time,
-                end=start_time + duration
-            )
-            midi_instrument.notes.append(note)
+    # Refine each peak to a fractional bin with a parabola through the log
+    # magnitudes of it and its neighbours (peaks on the band edge stay put)
+    last_bin = magnitude.shape[1] - 1
+    a = np.log(np.maximum(magnitude[frames, np.maximum(peak_bins - 1, 0)], 1e-10))
+    b = np.log(np.maximum(peak_mags, 1e-10))
+    c = np.log(np.maximum(magnitude[frames, np.minimum(peak_bins + 1, last_bin)], 1e-10))
+    curvature = a - 2 * b + c
+    inner = (peak_bins > 0) & (peak_bins < last_bin) & (curvature < 0)
+    delta = np.zeros(len(frames))
+    delta[inner] = np.clip(0.5 * (a - c)[inner] / curvature[inner], -0.5, 0.5)
+    peak_freqs = (band.start + peak_bins + delta) * sr / n_fft
+    midi_numbers = np.clip(np.rint(librosa.hz_to_midi(peak_freqs)), 21, 108).astype(np.int16)
+
+    # Magnitudes scale with the window length, keep threshold and velocity
+    # on the same scale as the original 2048-point STFT
+    peak_mags = peak_mags * (2048 / n_fft)
+    velocities = np.minimum(127, peak_mags * 100).astype(np.int8)
+
+    # Turn frame peaks into note events, then build the Note objects in one go
+    pitches, starts, ends, note_velocities = build_notes(
+        midi_numbers, velocities, peak_mags, times, threshold,
+        min_note_gap, min_note_duration, end_of_audio
+    )
+    midi_instrument.notes = [
+        pretty_midi.Note(velocity=int(v), pitch=int(p), start=float(s), end=float(e))
+        for p, s, e, v in zip(pitches, starts, ends, note_velocities)
+    ]
 
     midi.instruments.append(midi_instrument)
-    midi.write(output_midi)
-    print(f"✅ MIDI saved to {output_midi}")
-
-    # Synthesize MIDI to audio
-    if output_wav:
-        try:
-            audio = midi.fluidsynth(fs=sample_rate, sf2_path=soundfont_path)
-            sf.write(output_wav, audio, sample_rate)
-            print(f"✅ WAV saved to {output_wav}")
-        except Exception as e:
-            print(f"⚠️ Failed to render WAV: {e}")
+    return midi
+
+def render_wav(midi, output_wav, sample_rate=22050, soundfont_path="FluidR3_GM.sf2"):
+    """
+    Synthesize MIDI to WAV using fluidsynth.
+    
+    Parameters:
+        midi: PrettyMIDI object to render
+        output_wav: Output WAV file path
+        soundfont_path: Path to .sf2 SoundFont for MIDI synthesis
+    """
+    try:
+        audio = render_midi(midi, fs=sample_rate, sf2_path=soundfont_path)
+        sf.write(output_wav, audio, sample_rate)
+        print(f"✅ WAV saved to {output_wav}")
+    except Exception as e:
+        print(f"⚠️ Failed to render WAV: {e}")
+
+def audio_to_midi(input_file, output_midi, 
+                 instrument=0, min_note_duration=0.15, 
+                 min_note_gap=0.1, threshold=0.1, 
+                 sample_rate=22050,
+                 output_wav=None,
+                 soundfont_path="FluidR3_GM.sf2",
+                 cache_dir="cache"):
+    """
+    Convert audio to MIDI with realistic piano timing constraints,
+    then synthesize MIDI to WAV using fluidsynth.
+    
+    Parameters:
+        input_file: Input audio file path
+        output_midi: Output MIDI file path
+        output_wav: Output WAV file path
+        soundfont_path: Path to .sf2 SoundFont for MIDI synthesis
+        cache_dir: Directory for decoded audio (None disables the cache)
+    """
+    # Load audio file
+    y, sr = load_audio(input_file, sample_rate=sample_rate, cache_dir=cache_dir)
+    
+    midi = build_midi(y, sr, instrument=instrument,
+                      min_note_duration=min_note_duration,
+                      min_note_gap=min_note_gap, threshold=threshold)
+
+    # Synthesizing is the slow part, so write the MIDI file while it runs
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        if output_wav:
+            executor.submit(render_wav, midi, output_wav, sample_rate, soundfont_path)
+        midi.write(output_midi)
+        print(f"✅ MIDI saved to {output_midi}")
 
 if __name__ == "__main__":
     input_audio = "input-3.wav"  # CHANGE INPUT FILE NAME HERE
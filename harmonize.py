@@ -1,27 +1,44 @@
 import pretty_midi
 import numpy as np
 import soundfile as sf
-from music21 import key, stream, note, pitch, scale
+import functools
+import bisect
+from music21 import key
+from synth import render_midi
+
+# Octave and pitch class of every MIDI pitch, looked up instead of divided out
+_OCTAVE = (np.arange(128) // 12).astype(np.int8)
+_PITCH_CLASS = (np.arange(128) % 12).astype(np.int8)
+
+# Krumhansl-Schmuckler key profiles, the same weights music21 uses for 'key.krumhansl'
+MAJOR_PROFILE = np.array([6.35, 2.23, 3.48, 2.33, 4.38, 4.09, 2.52, 5.19, 2.39, 3.66, 2.29, 2.88])
+MINOR_PROFILE = np.array([6.33, 2.68, 3.52, 5.38, 2.60, 3.53, 2.54, 4.75, 3.98, 2.69, 3.34, 3.17])
+
+# One row per key: the 12 major keys on each tonic, then the 12 minor keys
+_KEY_PROFILES = np.array([np.roll(profile, tonic) for profile in (MAJOR_PROFILE, MINOR_PROFILE) for tonic in range(12)])
+_KEY_PROFILES -= _KEY_PROFILES.mean(axis=1, keepdims=True)
+_KEY_TONICS = ['C', 'C#', 'D', 'E-', 'E', 'F', 'F#', 'G', 'A-', 'A', 'B-', 'B',
+               'C', 'C#', 'D', 'E-', 'E', 'F', 'F#', 'G', 'G#', 'A', 'B-', 'B']
 
 def detect_key(midi_data):
-    """Robust key detection with proper note objects"""
-    s = stream.Stream()
+    """Krumhansl-Schmuckler key detection on a duration-weighted pitch-class histogram"""
+    pc_weights = np.zeros(12)
     
     for instrument in midi_data.instruments:
-        for midi_note in instrument.notes:
-            # Create note with proper duration
-            n = note.Note()
-            try:
-                n.pitch = pitch.Pitch(midi=midi_note.pitch)
-                n.duration.quarterLength = max(0.25, (midi_note.end - midi_note.start) * 4)
-                s.append(n)
-            except:
-                continue  # Skip problematic pitches
+        count = len(instrument.notes)
+        pitches = np.fromiter((n.pitch for n in instrument.notes), dtype=np.int16, count=count)
+        durations = np.fromiter((n.end - n.start for n in instrument.notes), dtype=np.float64, count=count)
+        # Weight by length in quarter notes (at 120 BPM), at least a sixteenth
+        np.add.at(pc_weights, _PITCH_CLASS[pitches], np.maximum(0.25, durations * 4))
     
-    if len(s.notes) == 0:
-        return key.Key('C')  # Default if no notes found
+    pc_weights -= pc_weights.mean()
+    if not pc_weights.any():
+        return key.Key('C')  # Default if no notes (or no tonal center) found
     
-    return s.analyze('key.krumhansl')
+    # Pearson correlation of the histogram with every key profile
+    scores = (_KEY_PROFILES @ pc_weights) / np.sqrt((_KEY_PROFILES ** 2).sum(axis=1) * (pc_weights ** 2).sum())
+    best = int(np.argmax(scores))
+    return key.Key(_KEY_TONICS[best], 'major' if best < 12 else 'minor')
 
 def get_diatonic_pitches(current_key):
     """Get all diatonic pitches for a key across octaves"""
@@ -34,28 +51,38 @@ def get_diatonic_pitches(current_key):
                 pitches.append(midi_pitch)
     return sorted(list(set(pitches)))
 
+@functools.lru_cache(maxsize=64)
+def _diatonic_cached(tonic, mode):
+    """Diatonic pitches for a key as a read-only array, built once per key"""
+    pitches = np.asarray(get_diatonic_pitches(key.Key(tonic, mode)), dtype=np.int16)
+    pitches.flags.writeable = False
+    return pitches
+
 def adjust_to_diatonic(pitch_num, diatonic_pitches):
-    """Find nearest diatonic pitch with binary search"""
-    # Binary search for nearest diatonic pitch
-    left = 0
-    right = len(diatonic_pitches) - 1
-    while left <= right:
-        mid = (left + right) // 2
-        if diatonic_pitches[mid] < pitch_num:
-            left = mid + 1
-        else:
-            right = mid - 1
-    
-    # Check nearest candidates
-    candidates = []
-    for i in [right, left]:
-        if 0 <= i < len(diatonic_pitches):
-            candidates.append(diatonic_pitches[i])
-    
-    if not candidates:
-        return pitch_num  # Fallback
-    
-    return min(candidates, key=lambda x: abs(x - pitch_num))
+    """Find nearest diatonic pitch with a C-level binary search"""
+    if len(diatonic_pitches) == 0:
+        return pitch_num
+
+    i = bisect.bisect_left(diatonic_pitches, pitch_num)
+    below = diatonic_pitches[i - 1] if i > 0 else diatonic_pitches[0]
+    above = diatonic_pitches[i] if i < len(diatonic_pitches) else diatonic_pitches[-1]
+    # Ties go to the lower pitch
+    return below if abs(pitch_num - below) <= abs(above - pitch_num) else above
+
+def adjust_pitches_to_diatonic(pitches, diatonic_pitches):
+    """Snap pitches to their nearest diatonic pitches in one batch, staying within an octave"""
+    diatonic_pitches = np.asarray(diatonic_pitches, dtype=np.int16)
+    last = len(diatonic_pitches) - 1
+    idx = np.searchsorted(diatonic_pitches, pitches)
+    below = diatonic_pitches[np.clip(idx - 1, 0, last)]
+    above = diatonic_pitches[np.clip(idx, 0, last)]
+    # Ties go to the lower candidate, same as adjust_to_diatonic
+    adjusted = np.where(np.abs(pitches - below) <= np.abs(above - pitches), below, above)
+
+    original_octave = _OCTAVE[pitches]
+    adjusted_octave = _OCTAVE[adjusted]
+    bad = np.abs(adjusted_octave - original_octave) > 1
+    return np.where(bad, (original_octave.astype(np.int16) * 12) + _PITCH_CLASS[adjusted], adjusted)
 
 def process_midi(input_midi_path, output_wav_path):
     """Complete MIDI processing pipeline"""
@@ -68,7 +95,7 @@ def process_midi(input_midi_path, output_wav_path):
         print(f"Detected key: {current_key}")
         
         # Get all diatonic pitches for this key
-        diatonic_pitches = get_diatonic_pitches(current_key)
+        diatonic_pitches = _diatonic_cached(current_key.tonic.name, current_key.mode)
         
         # Create new harmonized MIDI
         new_midi = pretty_midi.PrettyMIDI()
@@ -76,29 +103,20 @@ def process_midi(input_midi_path, output_wav_path):
         for instrument in midi_data.instruments:
             new_instr = pretty_midi.Instrument(program=instrument.program)
             
-            for n in instrument.notes:
-                # Adjust pitch while preserving octave
-                original_octave = n.pitch // 12
-                adjusted_pitch = adjust_to_diatonic(n.pitch, diatonic_pitches)
-                
-                # Ensure we stay in a reasonable octave
-                adjusted_octave = adjusted_pitch // 12
-                if abs(adjusted_octave - original_octave) > 1:
-                    adjusted_pitch = (original_octave * 12) + (adjusted_pitch % 12)
-                
-                new_note = pretty_midi.Note(
-                    velocity=n.velocity,
-                    pitch=adjusted_pitch,
-                    start=n.start,
-                    end=n.end
-                )
-                new_instr.notes.append(new_note)
+            # Adjust every pitch at once while preserving octave
+            pitches = np.fromiter((n.pitch for n in instrument.notes), dtype=np.int16, count=len(instrument.notes))
+            adjusted_pitches = adjust_pitches_to_diatonic(pitches, diatonic_pitches)
+            
+            new_instr.notes = [
+                pretty_midi.Note(velocity=n.velocity, pitch=adjusted_pitch, start=n.start, end=n.end)
+                for n, adjusted_pitch in zip(instrument.notes, adjusted_pitches.tolist())
+            ]
             
             new_midi.instruments.append(new_instr)
         
         # Synthesize audio
         try:
-            audio_data = new_midi.fluidsynth(fs=44100, sf2_path='FluidR3_GM.sf2')
+            audio_data = render_midi(new_midi, fs=44100, sf2_path='FluidR3_GM.sf2')
         except:
             print("Using basic synthesis")
             audio_data = new_midi.synthesize(fs=44100)
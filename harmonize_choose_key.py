@@ -2,8 +2,16 @@ import pretty_midi
 import numpy as np
 import soundfile as sf
 from music21 import key
+from synth import render_midi
 import re
+import functools
+import bisect
 
+# Octave and pitch class of every MIDI pitch, looked up instead of divided out
+_OCTAVE = (np.arange(128) // 12).astype(np.int8)
+_PITCH_CLASS = (np.arange(128) % 12).astype(np.int8)
+
+@functools.lru_cache(maxsize=64)
 def parse_user_key(user_input):
     try:
         tonic, mode = user_input.strip().split()
@@ -24,25 +32,36 @@ def get_diatonic_pitches(current_key):
                 pitches.append(midi_pitch)
     return sorted(list(set(pitches)))
 
-def adjust_to_diatonic(pitch_num, diatonic_pitches):
-    left = 0
-    right = len(diatonic_pitches) - 1
-    while left <= right:
-        mid = (left + right) // 2
-        if diatonic_pitches[mid] < pitch_num:
-            left = mid + 1
-        else:
-            right = mid - 1
-
-    candidates = []
-    for i in [right, left]:
-        if 0 <= i < len(diatonic_pitches):
-            candidates.append(diatonic_pitches[i])
+@functools.lru_cache(maxsize=64)
+def _diatonic_cached(user_key_str):
+    # Shared between calls, so keep it read-only
+    pitches = np.asarray(get_diatonic_pitches(parse_user_key(user_key_str)), dtype=np.int16)
+    pitches.flags.writeable = False
+    return pitches
 
-    if not candidates:
+def adjust_to_diatonic(pitch_num, diatonic_pitches):
+    if len(diatonic_pitches) == 0:
         return pitch_num
 
-    return min(candidates, key=lambda x: abs(x - pitch_num))
+    i = bisect.bisect_left(diatonic_pitches, pitch_num)
+    below = diatonic_pitches[i - 1] if i > 0 else diatonic_pitches[0]
+    above = diatonic_pitches[i] if i < len(diatonic_pitches) else diatonic_pitches[-1]
+    # Ties go to the lower pitch
+    return below if abs(pitch_num - below) <= abs(above - pitch_num) else above
+
+def adjust_pitches_to_diatonic(pitches, diatonic_pitches):
+    diatonic_pitches = np.asarray(diatonic_pitches, dtype=np.int16)
+    last = len(diatonic_pitches) - 1
+    idx = np.searchsorted(diatonic_pitches, pitches)
+    below = diatonic_pitches[np.clip(idx - 1, 0, last)]
+    above = diatonic_pitches[np.clip(idx, 0, last)]
+    # Ties go to the lower candidate, same as adjust_to_diatonic
+    adjusted = np.where(np.abs(pitches - below) <= np.abs(above - pitches), below, above)
+
+    original_octave = _OCTAVE[pitches]
+    adjusted_octave = _OCTAVE[adjusted]
+    bad = np.abs(adjusted_octave - original_octave) > 1
+    return np.where(bad, (original_octave.astype(np.int16) * 12) + _PITCH_CLASS[adjusted], adjusted)
 
 def parse_instrument(user_input):
     try:
@@ -61,41 +80,33 @@ def process_midi(input_midi_path, output_wav_path, user_key_str, instrument_prog
         current_key = parse_user_key(user_key_str)
         print(f"🎼 Using key: {current_key}")
 
-        diatonic_pitches = get_diatonic_pitches(current_key)
+        diatonic_pitches = _diatonic_cached(user_key_str)
 
         new_midi = pretty_midi.PrettyMIDI()
 
         for instrument in midi_data.instruments:
             new_instr = pretty_midi.Instrument(program=instrument_prog)
 
-            for n in instrument.notes:
-                original_octave = n.pitch // 12
-                adjusted_pitch = adjust_to_diatonic(n.pitch, diatonic_pitches)
-
-                adjusted_octave = adjusted_pitch // 12
-                if abs(adjusted_octave - original_octave) > 1:
-                    adjusted_pitch = (original_octave * 12) + (adjusted_pitch % 12)
-
-                start = n.start
-                end = n.end
+            pitches = np.fromiter((n.pitch for n in instrument.notes), dtype=np.int16, count=len(instrument.notes))
+            adjusted_pitches = adjust_pitches_to_diatonic(pitches, diatonic_pitches)
 
-                # Cut all notes that haven't ended before this note starts
-                for note in new_instr.notes:
-                    if note.end > start:
-                        note.end = start
+            new_instr.notes = [
+                pretty_midi.Note(velocity=n.velocity, pitch=adjusted_pitch, start=n.start, end=n.end)
+                for n, adjusted_pitch in zip(instrument.notes, adjusted_pitches.tolist())
+            ]
 
-                new_note = pretty_midi.Note(
-                    velocity=n.velocity,
-                    pitch=adjusted_pitch,
-                    start=start,
-                    end=end
-                )
-                new_instr.notes.append(new_note)
+            # Cut every note that hasn't ended before a later note starts,
+            # walking backwards with the earliest start seen so far
+            cutoff = float('inf')
+            for note in reversed(new_instr.notes):
+                if note.end > cutoff:
+                    note.end = cutoff
+                cutoff = min(cutoff, note.start)
 
             new_midi.instruments.append(new_instr)
 
         try:
-            audio_data = new_midi.fluidsynth(fs=44100, sf2_path='FluidR3_GM.sf2')
+            audio_data = render_midi(new_midi, fs=44100, sf2_path='FluidR3_GM.sf2')
         except:
             print("⚠️ fluidsynth failed, falling back to basic synth")
             audio_data = new_midi.synthesize(fs=44100)
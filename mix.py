@@ -8,31 +8,31 @@ def mix_wavs(wav_paths, output_path):
         print("⚠️ No input files provided.")
         return
 
-    audio_data = []
-    sample_rates = []
-
-    for path in wav_paths:
-        data, sr = sf.read(path)
-        audio_data.append(data)
-        sample_rates.append(sr)
+    # Read the headers first so the mix can be allocated once
+    infos = [sf.info(path) for path in wav_paths]
 
     # Make sure all sample rates are the same
-    if len(set(sample_rates)) > 1:
+    if len(set(info.samplerate for info in infos)) > 1:
         raise ValueError("🚨 All input WAV files must have the same sample rate.")
 
-    # Pad shorter arrays with zeros so they all have the same length
-    max_len = max(len(data) for data in audio_data)
-    padded_data = [
-        np.pad(data, ((0, max_len - len(data)), (0, 0)) if data.ndim > 1 else (0, max_len - len(data))) 
-        for data in audio_data
-    ]
+    # Add every track straight into the mix, shorter ones just stop early
+    max_len = max(info.frames for info in infos)
+    channels = max(info.channels for info in infos)
+    combined = np.zeros((max_len, channels), dtype=np.float32)
+    for path in wav_paths:
+        data, _ = sf.read(path, dtype='float32', always_2d=True)
+        if data.shape[1] == 1:
+            combined[:len(data)] += data  # Mono tracks play on every channel
+        else:
+            combined[:len(data), :data.shape[1]] += data
 
-    # Sum all tracks together and normalize
-    combined = np.sum(padded_data, axis=0)
-    combined /= np.max(np.abs(combined))  # Normalize to prevent clipping
+    # Normalize to prevent clipping, peak from max/min so no abs() copy is made
+    peak = max(combined.max(), -combined.min())
+    if peak > 0:
+        np.multiply(combined, 1.0 / peak, out=combined)
 
     # Save output
-    sf.write(output_path, combined, sample_rates[0])
+    sf.write(output_path, combined, infos[0].samplerate)
     print(f"✅ Output saved as: {output_path}")
 
 if __name__ == "__main__":
@@ -0,0 +1,98 @@
+import functools
+import threading
+import numpy as np
+
+try:
+    import fluidsynth
+    _HAS_FLUIDSYNTH = True
+except (ImportError, OSError):
+    _HAS_FLUIDSYNTH = False
+
+# A synth can only render one piece at a time
+_synth_lock = threading.Lock()
+
+@functools.lru_cache(maxsize=4)
+def get_synth(sf2_path, fs):
+    """
+    Start FluidSynth with the SoundFont loaded. Kept alive and reused for
+    every render with the same SoundFont and sample rate, so the .sf2 is
+    only read from disk once per process.
+    """
+    if not _HAS_FLUIDSYNTH:
+        raise ImportError("pyfluidsynth and the FluidSynth library are required to render MIDI.")
+    synth = fluidsynth.Synth(samplerate=fs)
+    sfid = synth.sfload(sf2_path)
+    if sfid == -1:
+        synth.delete()
+        raise IOError(f"Could not load SoundFont {sf2_path}")
+    return synth, sfid
+
+def render_instrument(synth, sfid, instrument, fs):
+    """Render one pretty_midi Instrument to a mono waveform (same layout as pretty_midi)"""
+    # Start from a clean synth: no held notes, bends or controller changes from the last render
+    synth.system_reset()
+
+    # Drums use channel 9 and bank 128, falling back to preset 0
+    if instrument.is_drum:
+        channel = 9
+        if synth.program_select(channel, sfid, 128, instrument.program) == -1:
+            synth.program_select(channel, sfid, 128, 0)
+    else:
+        channel = 0
+        synth.program_select(channel, sfid, 0, instrument.program)
+
+    events = []
+    for n in instrument.notes:
+        events.append((n.start, 1, 'note on', n.pitch, n.velocity))
+        events.append((n.end, 0, 'note off', n.pitch, 0))
+    for bend in instrument.pitch_bends:
+        events.append((bend.time, 1, 'pitch bend', bend.pitch, 0))
+    for control_change in instrument.control_changes:
+        events.append((control_change.time, 1, 'control change', control_change.number, control_change.value))
+    # Sort by time, note offs first
+    events.sort(key=lambda e: (e[0], e[1]))
+
+    # Leave 1 second after the last event for notes to ring out
+    end_time = events[-1][0] + 1.
+    synthesized = np.zeros(int(np.ceil(fs * end_time)))
+    next_times = [e[0] for e in events[1:]] + [end_time]
+
+    for (time, _, kind, a, b), next_time in zip(events, next_times):
+        if kind == 'note on':
+            synth.noteon(channel, a, b)
+        elif kind == 'note off':
+            synth.noteoff(channel, a)
+        elif kind == 'pitch bend':
+            synth.pitch_bend(channel, a)
+        else:
+            synth.cc(channel, a, b)
+        start = int(fs * time)
+        end = int(fs * next_time)
+        if end > start:
+            # Samples come back as interleaved stereo, keep the left channel
+            synthesized[start:end] += synth.get_samples(end - start)[::2]
+
+    return synthesized
+
+def render_midi(midi, fs=44100, sf2_path="FluidR3_GM.sf2"):
+    """
+    Render a PrettyMIDI object to a normalized mono waveform with a
+    persistent synth, instead of midi.fluidsynth() which starts FluidSynth
+    and reloads the SoundFont for every instrument of every call.
+    """
+    instruments = [i for i in midi.instruments if i.notes]
+    if not instruments:
+        return np.array([])
+
+    with _synth_lock:
+        synth, sfid = get_synth(sf2_path, fs)
+        waveforms = [render_instrument(synth, sfid, i, fs) for i in instruments]
+
+    synthesized = np.zeros(max(w.shape[0] for w in waveforms))
+    for waveform in waveforms:
+        synthesized[:waveform.shape[0]] += waveform
+
+    peak = max(synthesized.max(), -synthesized.min())
+    if peak > 0:
+        np.multiply(synthesized, 1.0 / peak, out=synthesized)
+    return synthesized